@@ -52,6 +52,7 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         init_std=0.02,
         scale_embedding=False,
         gradient_checkpointing=True,
+        gradient_checkpointing_policy=None,  # name of a jax.checkpoint_policies policy, eg "dots_saveable"
         use_scan=None,
         use_cache=True,
         is_encoder_decoder=True,
@@ -71,6 +72,8 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         use_glu=True,  # "GLU Variants Improve Transformer"
         use_alibi=False,  # Not implemented yet - from "Train Short, Test Long: Attention with Linear Biases Enables Input Length Extrapolation"
         sinkhorn_iters=1,  # used in SinkFormers
+        use_flash_attention=False,  # use FlashAttention kernels from flash-attention-jax
+        use_fp8_gemms=False,  # compute FFN and lm_head matmuls in float8
         use_final_ln_encoder=True,  # final layer normalization in encoder
         use_final_ln_decoder=True,  # final layer normalization in decoder
         # parameters that should not be necessary but could affect results
@@ -107,6 +110,13 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         self.use_glu = use_glu
         self.use_alibi = use_alibi
         self.sinkhorn_iters = sinkhorn_iters
+        if use_flash_attention:
+            assert not (
+                use_cosine_attention or use_swin_position_embeddings
+            ), "use_flash_attention is not compatible with cosine attention or swin position embeddings"
+            assert sinkhorn_iters == 1, "use_flash_attention requires sinkhorn_iters=1"
+        self.use_flash_attention = use_flash_attention
+        self.use_fp8_gemms = use_fp8_gemms
         if ln_positions == "postln":
             assert (
                 use_final_ln_encoder
@@ -137,6 +147,7 @@ class DalleBartConfig(PretrainedFromWandbMixin, PretrainedConfig):
         self.init_std = init_std
         self.use_cache = use_cache
         self.gradient_checkpointing = gradient_checkpointing
+        self.gradient_checkpointing_policy = gradient_checkpointing_policy
         # all layers are the same in most configurations
         self.use_scan = use_scan if use_scan is not None else ln_positions != "swinv2"
         assert not (
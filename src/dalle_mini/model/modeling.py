@@ -14,21 +14,22 @@
 # limitations under the License.
 """ DalleBart model. """
 
+import json
 import math
-from functools import partial
-from typing import Any, Dict, Optional, Tuple
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Optional, Tuple
 
 import flax
 import flax.linen as nn
 import jax
 import jax.numpy as jnp
+import numpy as np
 from einops import rearrange
-from flax.core.frozen_dict import unfreeze
-from flax.linen import combine_masks, make_causal_mask
+from flax.linen import combine_masks
 from flax.linen import partitioning as nn_partitioning
 from flax.linen.linear import PrecisionLike
 from flax.traverse_util import flatten_dict, unflatten_dict
-from jax import custom_jvp, lax
+from jax import custom_jvp, custom_vjp, lax
 from jax.random import PRNGKey
 from transformers.generation_flax_utils import FlaxSampleOutput
 from transformers.modeling_flax_outputs import (
@@ -49,11 +50,23 @@ from transformers.utils import logging
 from .configuration import DalleBartConfig
 from .utils import PretrainedFromWandbMixin
 
+try:
+    from flash_attention_jax import causal_flash_attention, flash_attention
+except ImportError:
+    causal_flash_attention = flash_attention = None
+
 logger = logging.get_logger(__name__)
 
 remat = nn_partitioning.remat
 
 
+def remat_policy(config):
+    """jax.checkpoint policy selected by `config.gradient_checkpointing_policy`."""
+    if config.gradient_checkpointing_policy is None:
+        return None
+    return getattr(jax.checkpoint_policies, config.gradient_checkpointing_policy)
+
+
 def smelu(beta: Any = 1.0):
     """
     Implementation of "Real World Large Scale Recommendation Systems Reproducibility and Smooth Activations"
@@ -175,6 +188,86 @@ class RMSNorm(nn.Module):
         return jnp.asarray(y, dtype)
 
 
+def quantize_fp8(x: Any, axis: int) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """Quantizes to float8 (e4m3) with one float32 scale per slice along `axis`."""
+    x = jnp.asarray(x, jnp.float32)
+    scale = jnp.max(jnp.abs(x), axis=axis, keepdims=True) / float(
+        jnp.finfo(jnp.float8_e4m3fn).max
+    )
+    scale = jnp.maximum(scale, jnp.finfo(jnp.float32).tiny)
+    return (x / scale).astype(jnp.float8_e4m3fn), scale
+
+
+@partial(custom_vjp, nondiff_argnums=(2,))
+def fp8_matmul(inputs: Any, kernel: Any, precision: Any = None) -> jnp.ndarray:
+    """
+    Product of `inputs` by `kernel` computed in float8 (e4m3), with one scale per
+    token for inputs and per output feature for the kernel.
+
+    The backward pass uses the unquantized operands in float32 since float8
+    cotangents would underflow.
+    """
+    inputs, inputs_scale = quantize_fp8(inputs, axis=-1)
+    kernel, kernel_scale = quantize_fp8(kernel, axis=0)
+    y = lax.dot_general(
+        inputs,
+        kernel,
+        (((inputs.ndim - 1,), (0,)), ((), ())),
+        precision=precision,
+        preferred_element_type=jnp.float32,
+    )
+    return y * inputs_scale * kernel_scale
+
+
+def fp8_matmul_fwd(inputs, kernel, precision):
+    return fp8_matmul(inputs, kernel, precision), (inputs, kernel)
+
+
+def fp8_matmul_bwd(precision, res, g):
+    inputs, kernel = res
+    batch_dims = tuple(range(inputs.ndim - 1))
+    inputs_grad = lax.dot_general(
+        g,
+        jnp.asarray(kernel, jnp.float32),
+        (((g.ndim - 1,), (1,)), ((), ())),
+        precision=precision,
+    )
+    kernel_grad = lax.dot_general(
+        jnp.asarray(inputs, jnp.float32),
+        g,
+        ((batch_dims, batch_dims), ((), ())),
+        precision=precision,
+    )
+    return inputs_grad.astype(inputs.dtype), kernel_grad.astype(kernel.dtype)
+
+
+fp8_matmul.defvjp(fp8_matmul_fwd, fp8_matmul_bwd)
+
+
+class Fp8Dense(nn.Dense):
+    """
+    Dense layer computing its matmul in float8 (e4m3) with dynamic per-row scaling.
+
+    Parameters are the same as nn.Dense so checkpoints can be used with either.
+    """
+
+    @nn.compact
+    def __call__(self, inputs: Any) -> Any:
+        kernel = self.param(
+            "kernel",
+            self.kernel_init,
+            (jnp.shape(inputs)[-1], self.features),
+            self.param_dtype,
+        )
+        y = fp8_matmul(inputs, kernel, self.precision)
+        if self.use_bias:
+            bias = self.param(
+                "bias", self.bias_init, (self.features,), self.param_dtype
+            )
+            y = y + bias
+        return jnp.asarray(y, self.dtype)
+
+
 def norm(type, *args, **kwargs):
     if type == "rmsnorm":
         return RMSNorm(*args, **kwargs)
@@ -184,6 +277,37 @@ def norm(type, *args, **kwargs):
         raise ValueError(f"Unknown norm type {type}")
 
 
+@lru_cache(maxsize=8)
+def get_generation_inputs(
+    batch_size: int, seq_length: int, max_length: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Boolean decoder attention mask of shape (batch_size, max_length - 1) and position
+    ids of shape (batch_size, seq_length) used for generation when no decoder mask is
+    given.
+
+    Only the most recently used shapes are kept since each mask is a host array.
+    """
+    mask = np.ones((batch_size, max_length - 1), dtype=bool)
+    mask.setflags(write=False)
+    position_ids = np.broadcast_to(
+        np.arange(seq_length, dtype="i4")[None, :], (batch_size, seq_length)
+    )
+    return mask, position_ids
+
+
+@lru_cache(maxsize=None)
+def get_causal_mask(length: int) -> np.ndarray:
+    """
+    Boolean causal mask of shape (1, 1, length, length).
+
+    Kept as a numpy constant so it is built once and shared by all decoder layers.
+    """
+    mask = np.tril(np.ones((length, length), dtype="bool"))[None, None]
+    mask.setflags(write=False)
+    return mask
+
+
 def dot_product_attention_weights(
     query: Any,
     key: Any,
@@ -257,11 +381,41 @@ def dot_product_attention_weights(
     return attn_weights
 
 
+class CrossAttentionCache(nn.Module):
+    """
+    Cache of the cross-attention keys and values.
+
+    The encoder states do not change during generation so the projections are
+    computed at the first decoding step and then read from the cache.
+    """
+
+    dtype: jnp.dtype = jnp.float32
+
+    @nn.compact
+    def __call__(self, shape):
+        """Creates the cache variables and returns whether the cache is filled."""
+        self.variable("cache", "cached_key", jnp.zeros, shape, self.dtype)
+        self.variable("cache", "cached_value", jnp.zeros, shape, self.dtype)
+        return self.variable("cache", "filled", lambda: jnp.array(False)).value
+
+    def read(self):
+        return (
+            self.get_variable("cache", "cached_key"),
+            self.get_variable("cache", "cached_value"),
+        )
+
+    def write(self, key_states, value_states):
+        self.put_variable("cache", "cached_key", key_states)
+        self.put_variable("cache", "cached_value", value_states)
+        self.put_variable("cache", "filled", jnp.array(True))
+
+
 class FlaxBartAttention(FlaxBartAttention):
     """
     Edits:
     - causal mask is used only in decoder and considers image_length
     - scale attention heads per NormFormer paper
+    - optional FlashAttention kernels (flash-attention-jax)
     """
 
     is_encoder: bool = False
@@ -287,26 +441,16 @@ class FlaxBartAttention(FlaxBartAttention):
             self.config
         )
 
-        self.q_proj = dense(
-            kernel_init=deepnet_init()
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std)
-        )
-        self.k_proj = dense(
-            kernel_init=deepnet_init()
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std)
-        )
-        self.v_proj = dense(
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std)
-        )
-        self.out_proj = dense(
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std)
-        )
+        # initializers are built once and shared by the projections
+        if self.config.use_deepnet_scaling:
+            init, scaled_init = deepnet_init(), deepnet_init(gain)
+        else:
+            init = scaled_init = jax.nn.initializers.normal(self.config.init_std)
+
+        self.q_proj = dense(kernel_init=init)
+        self.k_proj = dense(kernel_init=init)
+        self.v_proj = dense(kernel_init=scaled_init)
+        self.out_proj = dense(kernel_init=scaled_init)
         self.dropout_layer = nn.Dropout(rate=self.dropout)
 
         if self.config.use_head_scale:
@@ -325,16 +469,15 @@ class FlaxBartAttention(FlaxBartAttention):
             self.rel_bias = nn.Embed(
                 self.q_length,
                 self.k_length * self.num_heads,
-                embedding_init=deepnet_init()
-                if self.config.use_deepnet_scaling
-                else jax.nn.initializers.normal(self.config.init_std),
+                embedding_init=init,
             )
 
         if self.causal:
             # used only in decoder
-            self.causal_mask = make_causal_mask(
-                jnp.ones((1, self.config.image_length), dtype="bool"), dtype="bool"
-            )
+            self.causal_mask = get_causal_mask(self.config.image_length)
+
+        # used only in cross-attention during generation
+        self.cross_cache = CrossAttentionCache(dtype=self.dtype)
 
     def __call__(
         self,
@@ -356,8 +499,9 @@ class FlaxBartAttention(FlaxBartAttention):
         # get key, value proj
         if is_cross_attention:
             # cross_attentions
-            key_states = self.k_proj(key_value_states)
-            value_states = self.v_proj(key_value_states)
+            key_states, value_states = self._cross_key_value(
+                key_value_states, init_cache
+            )
         else:
             # self_attention
             key_states = self.k_proj(hidden_states)
@@ -367,6 +511,12 @@ class FlaxBartAttention(FlaxBartAttention):
         key_states = self._split_heads(key_states)
         value_states = self._split_heads(value_states)
 
+        if self._use_flash_attention(init_cache, deterministic):
+            attn_output = self._flash_attention(
+                query_states, key_states, value_states, attention_mask
+            )
+            return self._project_output(attn_output), None
+
         # handle cache prepare causal attention mask
         if self.causal:
             query_length, key_length = query_states.shape[1], key_states.shape[1]
@@ -428,8 +578,8 @@ class FlaxBartAttention(FlaxBartAttention):
 
         # relative position embeddings
         if self.config.use_swin_position_embeddings:
-            position_ids = jnp.arange(self.q_length)
-            embed_pos = self.rel_bias(position_ids)
+            # all positions are used so we can read the table directly
+            embed_pos = jnp.asarray(self.rel_bias.embedding, self.rel_bias.dtype)
             embed_pos = rearrange(embed_pos, "q (k h) -> 1 h q k", h=self.num_heads)
         else:
             embed_pos = None
@@ -454,13 +604,72 @@ class FlaxBartAttention(FlaxBartAttention):
             attn_weights = attn_weights / jnp.maximum(self.tau, 0.01)
 
         attn_output = jnp.einsum("...hqk,...khd->...qhd", attn_weights, value_states)
+
+        return self._project_output(attn_output), attn_weights
+
+    def _cross_key_value(self, key_value_states, init_cache: bool):
+        is_initialized = self.has_variable("cache", "cross_cache")
+        if not (init_cache or is_initialized):
+            return self.k_proj(key_value_states), self.v_proj(key_value_states)
+        is_filled = self.cross_cache(key_value_states.shape[:-1] + (self.embed_dim,))
+        if not is_initialized:
+            return self.k_proj(key_value_states), self.v_proj(key_value_states)
+
+        def read_cached(mdl, x):
+            return mdl.cross_cache.read()
+
+        def project_and_store(mdl, x):
+            key_states, value_states = mdl.k_proj(x), mdl.v_proj(x)
+            mdl.cross_cache.write(key_states, value_states)
+            return key_states, value_states
+
+        return nn.cond(is_filled, read_cached, project_and_store, self, key_value_states)
+
+    def _use_flash_attention(self, init_cache: bool, deterministic: bool) -> bool:
+        if not self.config.use_flash_attention:
+            return False
+        # single-step decoding relies on the cache and the sliced causal mask
+        if self.causal and (self.has_variable("cache", "cached_key") or init_cache):
+            return False
+        # attention dropout is not supported by the kernels
+        return deterministic or self.dropout == 0.0
+
+    def _flash_attention(self, query_states, key_states, value_states, attention_mask):
+        assert (
+            flash_attention is not None
+        ), 'Could not find flash_attention_jax. Install with "pip install flash-attention-jax"'
+        # kernels expect (batch, num_heads, length, head_dim)
+        query_states, key_states, value_states = (
+            jnp.swapaxes(x, 1, 2) for x in (query_states, key_states, value_states)
+        )
+        if self.causal:
+            # the causal kernel takes no mask, DalleBart rejects padded decoder inputs
+            attn_fn = causal_flash_attention
+        else:
+            if attention_mask is None:
+                attention_mask = jnp.ones(
+                    (key_states.shape[0], key_states.shape[2]), dtype="bool"
+                )
+            attention_mask = attention_mask.astype("bool")
+            attn_fn = lambda q, k, v: flash_attention(q, k, v, attention_mask)
+        # recompute the tiled softmax during backward pass but keep the matmuls
+        attn_fn = jax.checkpoint(
+            attn_fn, policy=jax.checkpoint_policies.dots_with_no_batch_dims_saveable
+        )
+        # the kernels only support float32 in their backward pass
+        attn_output = attn_fn(
+            query_states.astype(jnp.float32),
+            key_states.astype(jnp.float32),
+            value_states.astype(jnp.float32),
+        )
+        return jnp.swapaxes(attn_output, 1, 2).astype(self.dtype)
+
+    def _project_output(self, attn_output):
         if self.config.use_head_scale:
             # per Normformer
             attn_output = attn_output * self.head_scale
         attn_output = self._merge_heads(attn_output)
-        attn_output = self.out_proj(attn_output)
-
-        return attn_output, attn_weights
+        return self.out_proj(attn_output)
 
 
 class GLU(nn.Module):
@@ -486,22 +695,27 @@ class GLU(nn.Module):
                 epsilon=1e-05,
                 use_scale=self.config.force_ln_scale,
             )(x)
-        w = nn.Dense(
+        # embeddings, norms and attention are not quantized
+        dense = Fp8Dense if self.config.use_fp8_gemms else nn.Dense
+        kernel_init = (
+            deepnet_init(gain)
+            if self.config.use_deepnet_scaling
+            else jax.nn.initializers.normal(self.config.init_std)
+        )
+        w = dense(
             self.ffn_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std),
+            kernel_init=kernel_init,
+            name="Dense_0",
         )(x)
         w = ACT2FN[self.config.activation_function](w)
-        v = nn.Dense(
+        v = dense(
             self.ffn_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std),
+            kernel_init=kernel_init,
+            name="Dense_1",
         )(x)
         x = w * v
         if self.config.ln_positions in ["normformer"]:
@@ -515,13 +729,12 @@ class GLU(nn.Module):
             x, deterministic=deterministic
         )
 
-        x = nn.Dense(
+        x = dense(
             self.embed_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std),
+            kernel_init=kernel_init,
+            name="Dense_2",
         )(x)
         if self.config.ln_positions in ["swinv2", "cogview"]:
             x = norm(self.config.ln_type, dtype=self.dtype, epsilon=1e-05)(x)
@@ -551,13 +764,18 @@ class FFN(nn.Module):
                 epsilon=1e-05,
                 use_scale=self.config.force_ln_scale,
             )(x)
-        x = nn.Dense(
+        dense = Fp8Dense if self.config.use_fp8_gemms else nn.Dense
+        kernel_init = (
+            deepnet_init(gain)
+            if self.config.use_deepnet_scaling
+            else jax.nn.initializers.normal(self.config.init_std)
+        )
+        x = dense(
             self.ffn_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std),
+            kernel_init=kernel_init,
+            name="Dense_0",
         )(x)
         x = ACT2FN[self.config.activation_function](x)
         if self.config.ln_positions in ["normformer"]:
@@ -570,13 +788,12 @@ class FFN(nn.Module):
         x = nn.Dropout(rate=self.config.activation_dropout)(
             x, deterministic=deterministic
         )
-        x = nn.Dense(
+        x = dense(
             self.embed_dim,
             dtype=self.dtype,
             use_bias=self.config.use_bias,
-            kernel_init=deepnet_init(gain)
-            if self.config.use_deepnet_scaling
-            else jax.nn.initializers.normal(self.config.init_std),
+            kernel_init=kernel_init,
+            name="Dense_1",
         )(x)
         if self.config.ln_positions in ["swinv2", "cogview"]:
             x = norm(self.config.ln_type, dtype=self.dtype, epsilon=1e-05)(x)
@@ -787,6 +1004,7 @@ class FlaxBartDecoderLayer(nn.Module):
                 hidden_states=hidden_states,
                 key_value_states=encoder_hidden_states,
                 attention_mask=encoder_attention_mask,
+                init_cache=init_cache,
             )
             if self.config.ln_positions in ["normformer", "swinv2", "cogview"]:
                 hidden_states = norm(
@@ -870,6 +1088,7 @@ class FlaxBartEncoderLayerCollection(nn.Module):
                 FlaxBartEncoderLayer,
                 static_argnums=(2, 3),
                 prevent_cse=not self.config.use_scan,
+                policy=remat_policy(self.config),
             )
             if self.config.gradient_checkpointing
             else FlaxBartEncoderLayer
@@ -983,6 +1202,7 @@ class FlaxBartDecoderLayerCollection(nn.Module):
                 FlaxBartDecoderLayer,
                 static_argnums=(4, 5, 6),
                 prevent_cse=not self.config.use_scan,
+                policy=remat_policy(self.config),
             )
             if self.config.gradient_checkpointing
             else FlaxBartDecoderLayer
@@ -1081,6 +1301,26 @@ class FlaxBartDecoderLayerCollection(nn.Module):
         )
 
 
+def embed_inputs(module, input_ids, position_ids=None):
+    """
+    Token embedding, scaling, position embedding and layernorm of an encoder or decoder,
+    kept together so that they compile to a single fused elementwise region.
+    """
+    hidden_states = module.embed_tokens(input_ids)
+    # embed_scale is a python float so this is resolved at trace time
+    if module.embed_scale != 1.0:
+        hidden_states = hidden_states * module.embed_scale
+
+    if module.config.use_absolute_position_embeddings:
+        if position_ids is None:
+            # static positions, broadcast over the batch
+            position_ids = np.arange(input_ids.shape[-1])[None, :]
+        embed_pos = module.embed_positions(position_ids + module.offset)
+        hidden_states = hidden_states + embed_pos
+
+    return module.layernorm_embedding(hidden_states)
+
+
 class FlaxBartEncoder(nn.Module):
     config: DalleBartConfig
     embed_tokens: nn.Embed
@@ -1129,7 +1369,7 @@ class FlaxBartEncoder(nn.Module):
         self,
         input_ids,
         attention_mask,
-        position_ids,
+        position_ids: Optional[jnp.ndarray] = None,
         output_attentions: bool = False,
         output_hidden_states: bool = False,
         return_dict: bool = True,
@@ -1138,13 +1378,7 @@ class FlaxBartEncoder(nn.Module):
         input_shape = input_ids.shape
         input_ids = input_ids.reshape(-1, input_shape[-1])
 
-        hidden_states = self.embed_tokens(input_ids) * self.embed_scale
-
-        if self.config.use_absolute_position_embeddings:
-            embed_pos = self.embed_positions(position_ids + self.offset)
-            hidden_states = hidden_states + embed_pos
-
-        hidden_states = self.layernorm_embedding(hidden_states)
+        hidden_states = embed_inputs(self, input_ids, position_ids)
         hidden_states = self.dropout_layer(hidden_states, deterministic=deterministic)
 
         outputs = self.layers(
@@ -1220,7 +1454,7 @@ class FlaxBartDecoder(nn.Module):
         self,
         input_ids,
         attention_mask,
-        position_ids,
+        position_ids: Optional[jnp.ndarray] = None,
         encoder_hidden_states: Optional[jnp.ndarray] = None,
         encoder_attention_mask: Optional[jnp.ndarray] = None,
         init_cache: bool = False,
@@ -1232,13 +1466,7 @@ class FlaxBartDecoder(nn.Module):
         input_shape = input_ids.shape
         input_ids = input_ids.reshape(-1, input_shape[-1])
 
-        hidden_states = self.embed_tokens(input_ids) * self.embed_scale
-
-        if self.config.use_absolute_position_embeddings:
-            embed_pos = self.embed_positions(position_ids + self.offset)
-            hidden_states = hidden_states + embed_pos
-
-        hidden_states = self.layernorm_embedding(hidden_states)
+        hidden_states = embed_inputs(self, input_ids, position_ids)
         hidden_states = self.dropout_layer(hidden_states, deterministic=deterministic)
 
         outputs = self.layers(
@@ -1277,15 +1505,16 @@ class FlaxBartModule(FlaxBartModule):
     """
 
     def setup(self):
+        embedding_init = jax.nn.initializers.normal(self.config.init_std)
         encoder_embed_tokens = nn.Embed(
             self.config.encoder_vocab_size,
             self.config.d_model,
-            embedding_init=jax.nn.initializers.normal(self.config.init_std),
+            embedding_init=embedding_init,
         )
         decoder_embed_tokens = nn.Embed(
             self.config.image_vocab_size + 1,  # image vocab size + 1 for BOS
             self.config.d_model,
-            embedding_init=jax.nn.initializers.normal(self.config.init_std),
+            embedding_init=embedding_init,
         )
 
         self.encoder = FlaxBartEncoder(
@@ -1306,7 +1535,8 @@ class FlaxBartForConditionalGenerationModule(FlaxBartForConditionalGenerationMod
 
     def setup(self):
         self.model = FlaxBartModule(config=self.config, dtype=self.dtype)
-        self.lm_head = nn.Dense(
+        dense = Fp8Dense if self.config.use_fp8_gemms else nn.Dense
+        self.lm_head = dense(
             self.config.image_vocab_size
             + 1,  # image vocab size + 1 for BOS to have same size as decoder inputs (for sharding)
             use_bias=False,
@@ -1326,6 +1556,9 @@ class FlaxBartForConditionalGenerationModule(FlaxBartForConditionalGenerationMod
         output_hidden_states: bool = False,
         return_dict: bool = True,
         deterministic: bool = True,
+        logits_reduction: Optional[Callable] = None,
+        logits_reduction_inputs: Tuple[jnp.ndarray, ...] = (),
+        logits_chunk_size: int = 64,
     ):
         outputs = self.model(
             input_ids=input_ids,
@@ -1342,13 +1575,15 @@ class FlaxBartForConditionalGenerationModule(FlaxBartForConditionalGenerationMod
 
         hidden_states = outputs[0]
 
-        if self.config.tie_word_embeddings:
-            shared_embedding = self.model.variables["params"]["shared"]["embedding"]
-            lm_logits = self.lm_head.apply(
-                {"params": {"kernel": shared_embedding.T}}, hidden_states
+        if logits_reduction is not None:
+            return self._reduce_logits(
+                hidden_states,
+                logits_reduction,
+                logits_chunk_size,
+                logits_reduction_inputs,
             )
-        else:
-            lm_logits = self.lm_head(hidden_states)
+
+        lm_logits = self._compute_logits(hidden_states)
 
         if not return_dict:
             output = (lm_logits,) + outputs[1:]
@@ -1364,6 +1599,168 @@ class FlaxBartForConditionalGenerationModule(FlaxBartForConditionalGenerationMod
             encoder_attentions=outputs.encoder_attentions,
         )
 
+    def _compute_logits(self, hidden_states):
+        if self.config.tie_word_embeddings:
+            shared_embedding = self.model.variables["params"]["shared"]["embedding"]
+            # contract with the (vocab, d_model) embedding without transposing it
+            return lax.dot_general(
+                hidden_states.astype(self.dtype),
+                shared_embedding.astype(self.dtype),
+                (((hidden_states.ndim - 1,), (1,)), ((), ())),
+            )
+        return self.lm_head(hidden_states)
+
+    def _reduce_logits(
+        self, hidden_states, logits_reduction, chunk_size, reduction_inputs
+    ):
+        """
+        Apply `logits_reduction` to the logits of consecutive chunks of the sequence so that
+        the full (batch, seq_len, vocab) logits are never materialized.
+
+        `logits_reduction(logits, *inputs)` maps logits of shape (batch, chunk_size, vocab)
+        and the matching chunks of `reduction_inputs`, arrays of shape (batch, seq_len, ...),
+        to arrays whose leading axes are (batch, chunk_size), e.g. argmax over the vocabulary
+        or per-token cross entropy with the labels.
+
+        When `chunk_size` doesn't divide seq_len, the last chunk is padded and the
+        padded positions are dropped from the outputs.
+        """
+        batch_size, seq_len = hidden_states.shape[:2]
+        chunk_size = min(chunk_size, seq_len)
+        n_chunks = -(-seq_len // chunk_size)
+        padding = n_chunks * chunk_size - seq_len
+
+        def to_chunks(x):
+            # (n_chunks, batch, chunk_size, ...)
+            x = jnp.pad(x, ((0, 0), (0, padding)) + ((0, 0),) * (x.ndim - 2))
+            x = x.reshape(batch_size, n_chunks, chunk_size, *x.shape[2:])
+            return x.swapaxes(0, 1)
+
+        def reduce_chunk(chunks):
+            hidden_states, inputs = chunks
+            return logits_reduction(self._compute_logits(hidden_states), *inputs)
+
+        reduced = lax.map(
+            reduce_chunk,
+            (to_chunks(hidden_states), tuple(map(to_chunks, reduction_inputs))),
+        )
+        return jax.tree_util.tree_map(
+            lambda x: x.swapaxes(0, 1).reshape(batch_size, -1, *x.shape[3:])[
+                :, :seq_len
+            ],
+            reduced,
+        )
+
+
+def decoder_forward(
+    module,
+    decoder_input_ids,
+    decoder_attention_mask,
+    decoder_position_ids,
+    **kwargs,
+):
+    """Decoder followed by the language modeling head, used by DalleBart.decode."""
+    decoder_module = module._get_decoder_module()
+    outputs = decoder_module(
+        decoder_input_ids,
+        decoder_attention_mask,
+        decoder_position_ids,
+        **kwargs,
+    )
+    return module._compute_logits(outputs[0]), outputs
+
+
+@lru_cache(maxsize=8)
+def specialized_decoder_forward(output_attentions, output_hidden_states, deterministic):
+    """decoder_forward with fixed flags, one stable function per combination."""
+    return partial(
+        decoder_forward,
+        output_attentions=output_attentions,
+        output_hidden_states=output_hidden_states,
+        return_dict=True,
+        deterministic=deterministic,
+    )
+
+
+def decoder_step(module, *args, **kwargs):
+    """
+    Deterministic decoder_forward returning only the logits, used for cached generation
+    steps.
+    """
+    lm_logits, _ = decoder_forward(
+        module,
+        *args,
+        output_attentions=False,
+        output_hidden_states=False,
+        return_dict=True,
+        deterministic=True,
+        **kwargs,
+    )
+    return lm_logits
+
+
+def apply_without_cache(module, params, method, **kwargs):
+    """`module.apply` of a method that doesn't use the cache."""
+    return module.apply({"params": params}, method=method, **kwargs)
+
+
+def apply_with_cache(module, params, cache, method, **kwargs):
+    """
+    `module.apply` of a method updating the cache, with params and cache as separate
+    arguments so that the cache can be donated. Returns the outputs and updated cache.
+    """
+    outputs, variables = module.apply(
+        {"params": params, "cache": cache}, method=method, mutable=["cache"], **kwargs
+    )
+    return outputs, variables["cache"]
+
+
+def init_params(module, rng, input_shape):
+    """Random parameters, same inputs as FlaxBartPreTrainedModel.init_weights."""
+    input_ids = jnp.zeros(input_shape, dtype="i4")
+    attention_mask = jnp.ones_like(input_ids)
+    position_ids = jnp.broadcast_to(jnp.arange(input_shape[-1])[None, :], input_shape)
+    params_rng, dropout_rng = jax.random.split(rng)
+    rngs = {"params": params_rng, "dropout": dropout_rng}
+    return module.init(
+        rngs,
+        input_ids,
+        attention_mask,
+        input_ids,
+        attention_mask,
+        position_ids,
+        position_ids,
+    )["params"]
+
+
+@lru_cache(maxsize=4)
+def jitted_init_params(module_class, config_class, config_json, dtype, input_shape):
+    """
+    Compiled init_params, shared by models with the same configuration.
+
+    Only the most recently used are kept since each one holds a compiled graph.
+    """
+    config = config_class.from_dict(json.loads(config_json))
+    module = module_class(config=config, dtype=jnp.dtype(dtype))
+    return jax.jit(partial(init_params, module, input_shape=input_shape))
+
+
+def init_cache_variables(module, encoder_hidden_states, batch_size, max_length):
+    """
+    Cache collection used for generation, with the same container type as the cache
+    returned by `module.apply` so that it can be carried through lax.while_loop.
+    """
+    decoder_input_ids = jnp.ones((batch_size, max_length), dtype="i4")
+    return module.init(
+        jax.random.PRNGKey(0),
+        decoder_input_ids=decoder_input_ids,
+        decoder_attention_mask=jnp.ones_like(decoder_input_ids),
+        decoder_position_ids=None,
+        encoder_hidden_states=encoder_hidden_states,
+        init_cache=True,
+        method=decoder_forward,
+    )["cache"]
+
 
 @flax.struct.dataclass
 class SampleState:
@@ -1387,18 +1784,148 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
     - custom generate method to allow super conditions
     - num_params property
     - unscan function
+    - bfloat16 computation by default (parameters and norm statistics stay in float32)
+    - jitted init_weights shared between instances
+    - init_cache only traces the cache shapes, once per input shape
+    - decode with past_key_values is deterministic and doesn't output attentions or
+      hidden states
+    - decode donates past_key_values, which cannot be reused after the call
+    - padded decoder inputs are rejected with use_flash_attention
     """
 
     module_class = FlaxBartForConditionalGenerationModule
     config_class = DalleBartConfig
 
+    def __init__(
+        self,
+        config: DalleBartConfig,
+        input_shape: Tuple[int] = (1, 1),
+        seed: int = 0,
+        dtype: jnp.dtype = jnp.bfloat16,
+        _do_init: bool = True,
+        **kwargs,
+    ):
+        super().__init__(
+            config,
+            input_shape=input_shape,
+            seed=seed,
+            dtype=dtype,
+            _do_init=_do_init,
+            **kwargs,
+        )
+        # compiled decoding functions
+        self._apply_fns = {}
+        # cache structures, per batch size, max length and encoder output shape
+        self._cache_shapes = {}
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        pretrained_model_name_or_path,
+        *model_args,
+        dtype: jnp.dtype = jnp.bfloat16,
+        **kwargs,
+    ):
+        return super().from_pretrained(
+            pretrained_model_name_or_path, *model_args, dtype=dtype, **kwargs
+        )
+
+    def __call__(
+        self,
+        input_ids,
+        attention_mask=None,
+        decoder_input_ids=None,
+        decoder_attention_mask=None,
+        *args,
+        **kwargs,
+    ):
+        self._check_decoder_attention_mask(decoder_attention_mask)
+        return super().__call__(
+            input_ids,
+            attention_mask,
+            decoder_input_ids,
+            decoder_attention_mask,
+            *args,
+            **kwargs,
+        )
+
+    def _check_decoder_attention_mask(self, decoder_attention_mask):
+        """
+        The causal flash attention kernel cannot apply a decoder mask, so padded decoder
+        inputs are rejected here where the mask is concrete.
+        """
+        if (
+            self.config.use_flash_attention
+            and decoder_attention_mask is not None
+            and not isinstance(decoder_attention_mask, jax.core.Tracer)
+            and not np.all(decoder_attention_mask)
+        ):
+            raise ValueError(
+                "use_flash_attention does not support padded decoder inputs, the causal "
+                "kernel cannot apply decoder_attention_mask"
+            )
+
+    def init_weights(self, rng, input_shape, params=None):
+        if params is not None:
+            # only used to fill missing keys of a checkpoint
+            return super().init_weights(rng, input_shape, params)
+        init_fn = jitted_init_params(
+            self.module_class,
+            self.config_class,
+            self.config.to_json_string(),
+            jnp.dtype(self.dtype).name,
+            input_shape,
+        )
+        return init_fn(rng)
+
+    def _jitted_apply(self, method, use_cache):
+        """
+        Jitted `apply_with_cache` or `apply_without_cache`, compiled once per method.
+
+        The cache is donated so that it can be updated in place.
+        """
+        key = (method, use_cache)
+        if key not in self._apply_fns:
+            if use_cache:
+                self._apply_fns[key] = jax.jit(
+                    partial(apply_with_cache, self.module, method=method),
+                    donate_argnums=(1,),
+                )
+            else:
+                self._apply_fns[key] = jax.jit(
+                    partial(apply_without_cache, self.module, method=method)
+                )
+        return self._apply_fns[key]
+
+    def init_cache(self, batch_size, max_length, encoder_outputs):
+        # the cache is all zeros at initialization so the decoder doesn't need to run
+        encoder_hidden_states = encoder_outputs[0]
+        key = (
+            batch_size,
+            max_length,
+            encoder_hidden_states.shape,
+            jnp.dtype(encoder_hidden_states.dtype).name,
+        )
+        if key not in self._cache_shapes:
+            self._cache_shapes[key] = jax.eval_shape(
+                partial(
+                    init_cache_variables,
+                    self.module,
+                    batch_size=batch_size,
+                    max_length=max_length,
+                ),
+                encoder_hidden_states,
+            )
+        return jax.tree_util.tree_map(
+            lambda x: jnp.zeros(x.shape, x.dtype), self._cache_shapes[key]
+        )
+
     def num_params(self, params=None):
         if params is None:
             params = self.params
-        num_params = jax.tree_map(
-            lambda param: param.size, flatten_dict(unfreeze(params))
-        ).values()
-        return sum(list(num_params))
+        return jax.tree_util.tree_reduce(
+            lambda num_params, param: num_params + param.size, params, 0
+        )
 
     def unscan(self, params):
         if self.config.use_scan:
@@ -1448,23 +1975,13 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
             return_dict if return_dict is not None else self.config.return_dict
         )
 
+        # missing attention masks are kept as None and skipped by the attention layers
         encoder_hidden_states = encoder_outputs[0]
-        if encoder_attention_mask is None:
-            batch_size, sequence_length = encoder_hidden_states.shape[:2]
-            encoder_attention_mask = jnp.ones((batch_size, sequence_length))
-
-        batch_size, sequence_length = decoder_input_ids.shape
-        if decoder_attention_mask is None:
-            decoder_attention_mask = jnp.ones((batch_size, sequence_length))
 
-        if decoder_position_ids is None:
-            if past_key_values is not None:
-                raise ValueError(
-                    "Make sure to provide `decoder_position_ids` when passing `past_key_values`."
-                )
-
-            decoder_position_ids = jnp.broadcast_to(
-                jnp.arange(sequence_length)[None, :], (batch_size, sequence_length)
+        # the decoder uses static positions when decoder_position_ids is None
+        if decoder_position_ids is None and past_key_values is not None:
+            raise ValueError(
+                "Make sure to provide `decoder_position_ids` when passing `past_key_values`."
             )
 
         # Handle any PRNG if needed
@@ -1472,67 +1989,30 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
         if dropout_rng is not None:
             rngs["dropout"] = dropout_rng
 
-        inputs = {"params": params or self.params}
-
-        # if past_key_values are passed then cache is already initialized a private flag init_cache has to be
-        # passed down to ensure cache is used. It has to be made sure that cache is marked as mutable so that
-        # it can be changed by FlaxBartAttention module
-        if past_key_values:
-            inputs["cache"] = past_key_values
-            mutable = ["cache"]
-        else:
-            mutable = False
-
-        def _decoder_forward(
-            module,
-            decoder_input_ids,
-            decoder_attention_mask,
-            decoder_position_ids,
-            **kwargs,
-        ):
-            decoder_module = module._get_decoder_module()
-            outputs = decoder_module(
-                decoder_input_ids,
-                decoder_attention_mask,
-                decoder_position_ids,
-                **kwargs,
-            )
-            hidden_states = outputs[0]
-
-            if self.config.tie_word_embeddings:
-                shared_embedding = module.model.variables["params"]["shared"][
-                    "embedding"
-                ]
-                lm_logits = module.lm_head.apply(
-                    {"params": {"kernel": shared_embedding.T}}, hidden_states
-                )
-            else:
-                lm_logits = module.lm_head(hidden_states)
-
-            return lm_logits, outputs
-
-        outputs = self.module.apply(
-            inputs,
-            decoder_input_ids=jnp.array(decoder_input_ids, dtype="i4"),
-            decoder_attention_mask=jnp.array(decoder_attention_mask, dtype="i4"),
-            decoder_position_ids=jnp.array(decoder_position_ids, dtype="i4"),
+        decoder_inputs = dict(
+            decoder_input_ids=jnp.asarray(decoder_input_ids, dtype="i4"),
+            decoder_attention_mask=None
+            if decoder_attention_mask is None
+            else jnp.asarray(decoder_attention_mask, dtype=bool),
+            decoder_position_ids=None
+            if decoder_position_ids is None
+            else jnp.asarray(decoder_position_ids, dtype="i4"),
             encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=jnp.array(encoder_attention_mask, dtype="i4"),
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-            deterministic=not train,
+            encoder_attention_mask=None
+            if encoder_attention_mask is None
+            else jnp.asarray(encoder_attention_mask, dtype=bool),
             rngs=rngs,
-            mutable=mutable,
-            method=_decoder_forward,
         )
+        params = params or self.params
 
         if past_key_values is None:
-            lm_logits, decoder_outputs = outputs
-        else:
-            (lm_logits, decoder_outputs), past = outputs
-
-        if return_dict:
+            self._check_decoder_attention_mask(decoder_attention_mask)
+            decoder_forward_fn = specialized_decoder_forward(
+                output_attentions, output_hidden_states, not train
+            )
+            lm_logits, decoder_outputs = self._jitted_apply(
+                decoder_forward_fn, use_cache=False
+            )(params, **decoder_inputs)
             outputs = FlaxCausalLMOutputWithCrossAttentions(
                 logits=lm_logits,
                 hidden_states=decoder_outputs.hidden_states,
@@ -1540,16 +2020,16 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
                 cross_attentions=decoder_outputs.cross_attentions,
             )
         else:
-            outputs = (lm_logits,) + decoder_outputs[1:]
-
-        # add updated cache to model output
-        if past_key_values is not None and return_dict:
-            outputs["past_key_values"] = unfreeze(past["cache"])
-            return outputs
-        elif past_key_values is not None and not return_dict:
-            outputs = outputs[:1] + (unfreeze(past["cache"]),) + outputs[1:]
-
-        return outputs
+            # if past_key_values are passed then cache is already initialized and is
+            # marked as mutable so that it can be changed by FlaxBartAttention module
+            # only the logits and updated cache are needed during generation
+            lm_logits, cache = self._jitted_apply(decoder_step, use_cache=True)(
+                params, past_key_values, **decoder_inputs
+            )
+            outputs = FlaxCausalLMOutputWithCrossAttentions(
+                logits=lm_logits, past_key_values=cache
+            )
+        return outputs if return_dict else outputs.to_tuple()
 
     def prepare_inputs_for_generation(
         self,
@@ -1567,16 +2047,17 @@ class DalleBart(PretrainedFromWandbMixin, FlaxBartForConditionalGeneration):
         # Note that usually one would have to put 0's in the attention_mask for x > input_ids.shape[-1] and x < cache_length.
         # But since the decoder uses a causal mask, those positions are masked anyways.
         # Thus we can create a single static attention_mask here, which is more efficient for compilation
-        extended_attention_mask = jnp.ones((batch_size, max_length - 1), dtype="i4")
-        if decoder_attention_mask is not None:
-            position_ids = decoder_attention_mask.cumsum(axis=-1) - 1
-            extended_attention_mask = lax.dynamic_update_slice(
-                extended_attention_mask, decoder_attention_mask, (0, 0)
+        if decoder_attention_mask is None:
+            extended_attention_mask, position_ids = get_generation_inputs(
+                batch_size, seq_length, max_length
             )
         else:
-            position_ids = jnp.broadcast_to(
-                jnp.arange(seq_length, dtype="i4")[None, :], (batch_size, seq_length)
+            extended_attention_mask = jnp.pad(
+                decoder_attention_mask.astype(bool),
+                ((0, 0), (0, max_length - 1 - seq_length)),
+                constant_values=True,
             )
+            position_ids = (extended_attention_mask.cumsum(axis=-1) - 1)[:, :seq_length]
 
         return {
             "past_key_values": past_key_values,
@@ -0,0 +1,30 @@
+import jax.numpy as jnp
+import pytest
+
+from dalle_mini.model import DalleBart, DalleBartConfig
+
+
+@pytest.fixture
+def tiny_model():
+    """Factory of small randomly initialized models."""
+
+    def make_model(dtype=jnp.float32, **kwargs):
+        config = DalleBartConfig(
+            encoder_vocab_size=64,
+            image_vocab_size=32,
+            image_length=6,
+            max_text_length=8,
+            encoder_layers=2,
+            decoder_layers=2,
+            encoder_ffn_dim=32,
+            decoder_ffn_dim=32,
+            encoder_attention_heads=2,
+            decoder_attention_heads=2,
+            d_model=16,
+            dropout=0.0,
+            gradient_checkpointing=False,
+            **kwargs,
+        )
+        return DalleBart(config, seed=0, dtype=dtype)
+
+    return make_model
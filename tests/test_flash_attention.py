@@ -0,0 +1,53 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+pytest.importorskip("flash_attention_jax")
+
+
+def loss_fn(model, decoder_attention_mask=None):
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 64)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 6), 0, 32)
+
+    def loss(params):
+        logits = model(
+            input_ids,
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=decoder_attention_mask,
+            params=params,
+        ).logits
+        return jnp.mean(logits.astype(jnp.float32) ** 2)
+
+    return loss
+
+
+def test_flash_attention_matches_dense(tiny_model):
+    dense = tiny_model()
+    flash = tiny_model(use_flash_attention=True)
+    loss, grads = jax.value_and_grad(loss_fn(dense))(dense.params)
+    flash_loss, flash_grads = jax.value_and_grad(loss_fn(flash))(dense.params)
+    np.testing.assert_allclose(flash_loss, loss, rtol=1e-4)
+    for grad, flash_grad in zip(
+        jax.tree_util.tree_leaves(grads), jax.tree_util.tree_leaves(flash_grads)
+    ):
+        np.testing.assert_allclose(flash_grad, grad, atol=1e-4)
+
+
+def test_flash_attention_bfloat16_backward(tiny_model):
+    model = tiny_model(use_flash_attention=True, dtype=jnp.bfloat16)
+    grads = jax.grad(loss_fn(model))(model.params)
+    assert all(jnp.isfinite(grad).all() for grad in jax.tree_util.tree_leaves(grads))
+
+
+def test_flash_attention_rejects_padded_decoder_inputs(tiny_model):
+    model = tiny_model(use_flash_attention=True)
+    decoder_attention_mask = jnp.ones((2, 6), dtype="i4").at[0, -1].set(0)
+    with pytest.raises(ValueError, match="padded decoder inputs"):
+        loss_fn(model, decoder_attention_mask)(model.params)
+
+
+def test_flash_attention_has_no_host_callback(tiny_model):
+    model = tiny_model(use_flash_attention=True)
+    jaxpr = jax.make_jaxpr(loss_fn(model))(model.params)
+    assert "callback" not in str(jaxpr)
@@ -0,0 +1,38 @@
+import flax.linen as nn
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from dalle_mini.model.modeling import Fp8Dense
+
+
+def relative_error(x, y):
+    return jnp.linalg.norm(x - y) / jnp.linalg.norm(y)
+
+
+def test_fp8_dense_matches_dense():
+    inputs = jax.random.normal(jax.random.PRNGKey(0), (2, 8, 64))
+    targets = jax.random.normal(jax.random.PRNGKey(1), (2, 8, 128))
+    dense = nn.Dense(128, use_bias=False)
+    params = dense.init(jax.random.PRNGKey(2), inputs)
+
+    def loss_fn(module):
+        def loss(params, inputs):
+            return jnp.sum(module.apply(params, inputs) * targets)
+
+        return loss
+
+    y = dense.apply(params, inputs)
+    fp8_y = Fp8Dense(128, use_bias=False).apply(params, inputs)
+    # e4m3 keeps 3 mantissa bits
+    assert relative_error(fp8_y, y) < 0.05
+
+    grads = jax.grad(loss_fn(dense), argnums=(0, 1))(params, inputs)
+    fp8_grads = jax.grad(loss_fn(Fp8Dense(128, use_bias=False)), argnums=(0, 1))(
+        params, inputs
+    )
+    for grad, fp8_grad in zip(
+        jax.tree_util.tree_leaves(grads), jax.tree_util.tree_leaves(fp8_grads)
+    ):
+        assert (fp8_grad != 0).mean() == (grad != 0).mean()
+        np.testing.assert_allclose(fp8_grad, grad, rtol=1e-2, atol=1e-3)
@@ -0,0 +1,82 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from dalle_mini.model.modeling import get_generation_inputs
+
+
+def reference_greedy(model, input_ids, attention_mask):
+    """Greedy decoding without cache, running the full prefix at every step."""
+    encoder_outputs = model.encode(input_ids, attention_mask=attention_mask)
+    sequences = jnp.full(
+        (input_ids.shape[0], 1), model.config.decoder_start_token_id, dtype="i4"
+    )
+    for _ in range(model.config.image_length):
+        logits = model.decode(
+            sequences, encoder_outputs, encoder_attention_mask=attention_mask
+        ).logits
+        # BOS is never generated
+        next_token = jnp.argmax(logits[:, -1, : model.config.image_vocab_size], -1)
+        sequences = jnp.concatenate([sequences, next_token[:, None]], axis=-1)
+    return sequences
+
+
+@pytest.mark.parametrize("use_scan", [True, False])
+def test_greedy_generate_matches_uncached_decoding(tiny_model, use_scan):
+    model = tiny_model(use_scan=use_scan)
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 64)
+    attention_mask = jnp.ones_like(input_ids).at[1, 5:].set(0)
+
+    # BOS is never generated
+    model.params["lm_head"]["kernel"] = (
+        model.params["lm_head"]["kernel"].at[:, -1].set(-1e3)
+    )
+    sequences = model.generate(
+        input_ids, attention_mask=attention_mask, do_sample=False
+    ).sequences
+
+    expected = reference_greedy(model, input_ids, attention_mask)
+    np.testing.assert_array_equal(sequences, expected)
+
+
+@pytest.mark.parametrize("condition_scale", [1.0, 3.0])
+def test_sample_generate(tiny_model, condition_scale):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 64)
+    sequences = model.generate(
+        input_ids,
+        prng_key=jax.random.PRNGKey(2),
+        condition_scale=condition_scale,
+        input_ids_uncond=jnp.zeros_like(input_ids),
+    ).sequences
+    assert sequences.shape == (2, model.config.image_length + 1)
+    assert (sequences[:, 1:] <= model.config.image_vocab_size).all()
+
+
+def test_generation_position_ids_follow_decoder_mask(tiny_model):
+    model = tiny_model()
+    input_ids = jnp.ones((2, 8), dtype="i4")
+    decoder_input_ids = jnp.ones((2, 3), dtype="i4")
+    decoder_attention_mask = jnp.array([[1, 1, 1], [0, 1, 1]])
+    inputs = model.prepare_inputs_for_generation(
+        decoder_input_ids,
+        model.config.image_length + 1,
+        decoder_attention_mask=decoder_attention_mask,
+        encoder_outputs=model.encode(input_ids),
+    )
+    np.testing.assert_array_equal(
+        inputs["decoder_position_ids"], [[0, 1, 2], [-1, 0, 1]]
+    )
+    np.testing.assert_array_equal(
+        inputs["decoder_attention_mask"][:, :3], decoder_attention_mask
+    )
+    assert inputs["decoder_attention_mask"][:, 3:].all()
+
+
+def test_generation_inputs_cache_is_bounded():
+    get_generation_inputs.cache_clear()
+    for batch_size in range(1, 11):
+        get_generation_inputs(batch_size, 1, 7)
+    cache_info = get_generation_inputs.cache_info()
+    assert cache_info.currsize == cache_info.maxsize == 8
@@ -0,0 +1,32 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from dalle_mini.model import DalleBart
+from dalle_mini.model.modeling import jitted_init_params
+
+
+def test_init_weights_shared_and_bounded(tiny_model):
+    jitted_init_params.cache_clear()
+    params = tiny_model().params
+    same_params = tiny_model().params
+    assert jitted_init_params.cache_info().hits == 1
+    for x, y in zip(
+        jax.tree_util.tree_leaves(params), jax.tree_util.tree_leaves(same_params)
+    ):
+        np.testing.assert_array_equal(x, y)
+
+    # a sweep over configurations only keeps the most recently used inits
+    for init_std in [0.01, 0.03, 0.04, 0.05, 0.06]:
+        tiny_model(init_std=init_std)
+    cache_info = jitted_init_params.cache_info()
+    assert cache_info.currsize == cache_info.maxsize == 4
+    tiny_model()
+    assert jitted_init_params.cache_info().misses == cache_info.misses + 1
+
+
+def test_positional_init_arguments(tiny_model):
+    config = tiny_model().config
+    model = DalleBart(config, (1, 2), 1)
+    assert model.dtype == jnp.bfloat16
+    assert model.num_params() == tiny_model().num_params()
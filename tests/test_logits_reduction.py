@@ -0,0 +1,41 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import pytest
+
+
+# 4 doesn't divide the 6 image tokens so the last chunk is padded
+@pytest.mark.parametrize("logits_chunk_size", [2, 4])
+def test_chunked_logits_reduction_matches_full_logits(tiny_model, logits_chunk_size):
+    model = tiny_model()
+    input_ids = jax.random.randint(jax.random.PRNGKey(1), (2, 8), 0, 64)
+    decoder_input_ids = jax.random.randint(jax.random.PRNGKey(2), (2, 6), 0, 32)
+    labels = jax.random.randint(jax.random.PRNGKey(3), (2, 6), 0, 32)
+
+    logits = model(input_ids, decoder_input_ids=decoder_input_ids).logits
+
+    def token_loss_fn(logits, labels):
+        return optax.softmax_cross_entropy_with_integer_labels(logits, labels)
+
+    def reduce(logits_reduction, *logits_reduction_inputs):
+        # same call as the eval step of the training script
+        return model.module.apply(
+            {"params": model.params},
+            input_ids=input_ids,
+            attention_mask=None,
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=None,
+            position_ids=None,
+            decoder_position_ids=None,
+            logits_reduction=logits_reduction,
+            logits_reduction_inputs=logits_reduction_inputs,
+            logits_chunk_size=logits_chunk_size,
+        )
+
+    np.testing.assert_allclose(
+        reduce(token_loss_fn, labels), token_loss_fn(logits, labels), rtol=1e-5
+    )
+    np.testing.assert_array_equal(
+        reduce(lambda x: jnp.argmax(x, axis=-1)), jnp.argmax(logits, axis=-1)
+    )
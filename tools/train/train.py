@@ -20,6 +20,7 @@ Script adapted from run_summarization_flax.py
 
 import io
 import logging
+import mmap
 import os
 import sys
 import tempfile
@@ -170,7 +171,8 @@ class ModelArguments:
                 return blob.download_as_bytes()
 
             with Path(self.restore_state).open("rb") as f:
-                return f.read()
+                # map the file instead of reading it to avoid an extra copy in memory
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
 
 @dataclass
@@ -559,7 +561,7 @@ class TrainingArguments:
 
 def split_params(data):
     """Split params between scanned and non-scanned"""
-    flat = traverse_util.flatten_dict(unfreeze(data))
+    flat = traverse_util.flatten_dict(data)
     split = {"standard": {}, "scanned_encoder": {}, "scanned_decoder": {}}
     for k, v in flat.items():
         if "FlaxBartEncoderLayers" in k:
@@ -579,7 +581,7 @@ def unsplit_params(data):
     flat = {}
     for k in ["standard", "scanned_encoder", "scanned_decoder"]:
         if k in data:
-            flat.update(traverse_util.flatten_dict(unfreeze(data[k])))
+            flat.update(traverse_util.flatten_dict(data[k]))
     return freeze(traverse_util.unflatten_dict(flat))
 
 
@@ -1094,8 +1096,11 @@ def main():
     grad_batch_spec = PartitionSpec(None, "dp")
 
     # define loss
+    def token_loss_fn(logits, labels):
+        return optax.softmax_cross_entropy(logits, onehot(labels, logits.shape[-1]))
+
     def loss_fn(logits, labels):
-        loss = optax.softmax_cross_entropy(logits, onehot(labels, logits.shape[-1]))
+        loss = token_loss_fn(logits, labels)
         loss = loss.mean()
         return loss
 
@@ -1277,8 +1282,18 @@ def main():
     def eval_step(state, batch):
         def compute_eval_loss(batch):
             batch, labels = batch.pop("labels")
-            logits = eval_model(**batch, params=state.params, train=False)[0]
-            return loss_fn(logits, labels)
+            # the loss is reduced by chunks of the sequence so that the full logits
+            # are never materialized, missing masks and positions use their defaults
+            loss = eval_model.module.apply(
+                {"params": state.params},
+                **batch,
+                decoder_attention_mask=None,
+                position_ids=None,
+                decoder_position_ids=None,
+                logits_reduction=token_loss_fn,
+                logits_reduction_inputs=(labels,),
+            )
+            return loss.mean()
 
         if use_vmap_trick:
             loss = jax.vmap(compute_eval_loss)(batch)